@@ -15,23 +15,13 @@
 
 import subprocess
 import sys
+import os
+import shutil
 import argparse
 import time
-try: 
-    import DuetWebAPI as DWA
-except ImportError:
-    print("Python Library Module 'DuetWebAPI.py' is required. ")
-    print("Obtain from https://github.com/DanalEstes/DuetWebAPI ")
-    print("Place in same directory as script, or in Python libpath.")
-    exit(2)
-
-try: 
-    import numpy as np
-except ImportError:
-    print("Python Library Module 'numpy' is required. ")
-    print("Obtain via 'sudo python3 -m pip install numpy'")
-    exit(2)
-
+import json
+import threading
+import queue
 
 # Globals.
 zo = 0                  # Z coordinate old
@@ -39,6 +29,15 @@ frame = 0               # Frame counter for file names
 printerState  = 0       # State machine for print idle before print, printing, idle after print. 
 timePriorPhoto = 0      # Time of last interval based photo, in time.time() format. 
 alreadyPaused  = False  # If printer is paused, have we taken our actions yet? 
+zFromModel     = True   # Does the printer answer rr_model queries for Z alone? 
+photos = queue.Queue()  # Frame numbers waiting to be captured by photoWorker.
+videoFailed    = False  # Set by photoWorker if ffmpeg goes away. 
+
+# Printer states, named as in the RRF3 object model.  RRF2 reports single letters. 
+IDLE, PRINTING, SIMULATING, PAUSED, PAUSING, RESUMING = 'idle', 'processing', 'simulating', 'paused', 'pausing', 'resuming'
+BUSY, CHANGING, FLASHING, HALTED, OFF = 'busy', 'changingTool', 'updating', 'halted', 'off'
+STATUS = {'I':IDLE, 'P':PRINTING, 'M':SIMULATING, 'S':PAUSED, 'A':PAUSED, 'D':PAUSING, 'R':RESUMING,
+          'B':BUSY, 'C':BUSY, 'T':CHANGING, 'F':FLASHING, 'H':HALTED, 'O':OFF}
 
 ###########################
 # Methods begin here
@@ -67,27 +66,33 @@ def init():
     weburl   = args['weburl'][0]
     duetpw   = args['duetpw'][0]
 
+    # Resolve options once, rather than string testing them on every tick. 
+    global detectLayer, detectPause, forcePause
+    detectLayer = (detect == 'layer')
+    detectPause = (detect == 'pause')
+    forcePause  = (pause == 'yes')
+
     # Warn user if we havent' implemented something yet. 
-    if ('dlsr' in camera):
+    if (camera == 'dslr'):
         print('DuetLapse.py: error: Camera type '+camera+' not yet supported.')
         exit(2)
 
     # Inform regarding valid and invalid combinations
-    if ((seconds > 0) and (not 'none' in detect)):
+    if ((seconds > 0) and (not detect == 'none')):
         print('Warning: -seconds '+str(seconds)+' and -detect '+detect+' will trigger on both.')
         print('Specify "-detect none" with "-seconds" to trigger on seconds alone.')
 
-    if ((not movehead == [0.0,0.0]) and ((not 'yes' in pause) and (not 'pause' in detect))):
+    if ((not movehead == [0.0,0.0]) and ((not forcePause) and (not detectPause))):
         print('Invalid Combination: "-movehead {0:1.2f} {1:1.2f}" requires either "-pause yes" or "-detect pause".'.format(movehead[0],movehead[1]))
         exit(2)
 
-    if (('yes' in pause) and ('pause' in detect)):
+    if (forcePause and detectPause):
         print('Invalid Combination: "-pause yes" causes this script to pause printer when')
         print('other events are detected, and "-detect pause" requires the gcode on the printer')
         print('contain its own pauses.  These are fundamentally incompatible.')
         exit(2)
 
-    if ('pause' in detect):
+    if (detectPause):
         print('************************************************************************************')
         print('* Note "-detect pause" means that the G-Code on the printer already contains pauses,')
         print('* and that this script will detect them, take a photo, and issue a resume.')
@@ -100,7 +105,7 @@ def init():
         print('************************************************************************************')
 
 
-    if ('yes' in pause):
+    if (forcePause):
         print('************************************************************************************')
         print('* Note "-pause yes" means this script will pause the printer when the -detect or ')
         print('* -seconds flags trigger.')
@@ -111,29 +116,35 @@ def init():
         print('************************************************************************************')
 
 
-    # Check for requsite commands
-    if ('usb' in camera):
-        if (20 > len(subprocess.check_output('whereis fswebcam', shell=True))):
-            print("Module 'fswebcam' is required. ")
-            print("Obtain via 'sudo apt install fswebcam'")
-            exit(2)
-
-    if ('pi' in camera):
-        if (20 > len(subprocess.check_output('whereis raspistill', shell=True))):
-            print("Module 'raspistill' is required. ")
-            print("Obtain via 'sudo apt install raspistill'")
-            exit(2)
+    # Network modules are only imported once the command line is known good, so -h stays quick.
+    global DWA, requests, websocket, session
+    try: 
+        import DuetWebAPI as DWA
+    except ImportError:
+        print("Python Library Module 'DuetWebAPI.py' is required. ")
+        print("Obtain from https://github.com/DanalEstes/DuetWebAPI ")
+        print("Place in same directory as script, or in Python libpath.")
+        exit(2)
+    import requests     # Required by DuetWebAPI as well, so present if we got this far.
+    try: 
+        import websocket    # Optional; lets RRF3 under DSF push object model changes to us.
+    except ImportError:
+        websocket = None
 
-    if ('web' in camera):
-        if (20 > len(subprocess.check_output('whereis wget', shell=True))):
-            print("Module 'wget' is required. ")
-            print("Obtain via 'sudo apt install wget'")
-            exit(2)
+    # One kept-alive connection to the Duet for every request, rather than a new TCP connection each poll.
+    session = requests.Session()
+    session.mount('http://',requests.adapters.HTTPAdapter(pool_connections=1,pool_maxsize=2))
 
-    if (20 > len(subprocess.check_output('whereis ffmpeg', shell=True))):
+    # Check for requsite commands
+    if (shutil.which('ffmpeg') is None):
         print("Module 'ffmpeg' is required. ")
         print("Obtain via 'sudo apt install ffmpeg'")
         exit(2)
+    global encoder
+    encoder = pickEncoder()
+
+    # Open the camera once, and keep it warm for the whole run.
+    openCamera()
 
     # Get connected to the printer.
 
@@ -143,7 +154,9 @@ def init():
     if (not printer.printerType()):
         print('Device at '+duet+' either did not respond or is not a Duet V2 or V3 printer.')
         exit(2)
-    printer = DWA.DuetWebAPI('http://'+duet,duetpw)
+    # DuetWebAPI makes its calls through self.requests; a Session has the same get/post,
+    # so its status, coordinate and gcode calls share our kept-alive connection.
+    if (hasattr(printer,'requests')): printer.requests = session
 
     print("Connected to a Duet V"+str(printer.printerType())+" printer at "+printer.baseURL())
 
@@ -156,14 +169,11 @@ def init():
     print("# seconds  = {0:20s}#".format(str(seconds)))
     print("# detect   = {0:20s}#".format(detect))
     print("# pause    = {0:20s}#".format(pause))
+    print("# encoder  = {0:20s}#".format(encoder[1]))
     print("# movehead = {0:6.2f} {1:6.2f}       #".format(movehead[0],movehead[1]))
     print("##################################")
     print()
 
-    # Clean up directory from past runs.  Be silent if it does not exist. 
-    subprocess.call('rm -r /tmp/DuetLapse > /dev/null 2>&1', shell=True)
-    subprocess.call('mkdir /tmp/DuetLapse', shell=True)
-
     print('Waiting for print to start on printer '+duet)
 
 def checkForcePause():
@@ -171,95 +181,289 @@ def checkForcePause():
     # Checks to see if we should pause; if so, returns after pause and head movement complete.
     global alreadyPaused
     if (alreadyPaused): return
-    if (not 'yes' in pause): return
+    if (not forcePause): return
     print('Requesting pause via M25')
-    printer.gCode('M25')    # Ask for a pause
-    printer.gCode('M400')   # Make sure the pause finishes
-    alreadyPaused = True 
+    gc = 'M25\nM400\n'        # Ask for a pause, and make sure it finishes
     if(not movehead == [0.0,0.0]):
         print('Moving print head to X{0:4.2f} Y{1:4.2f}'.format(movehead[0],movehead[1]))
-        printer.gCode('G1 X{0:4.2f} Y{1:4.2f}'.format(movehead[0],movehead[1]))
-        printer.gCode('M400')   # Make sure the move finishes
+        gc += 'G1 X{0:4.2f} Y{1:4.2f}\nM400\n'.format(movehead[0],movehead[1])
+    printer.gCode(gc)       # One request to the Duet for the whole sequence
+    alreadyPaused = True 
 
 def unPause():
     global alreadyPaused
     if (alreadyPaused):
+        photos.join()           # Stay paused until the camera has its frame.
         print('Requesting un pause via M24')
         printer.gCode('M24')
         alreadyPaused = False
 
+def openCamera():
+    global cam
+    if (camera == 'usb'):
+        global cv2
+        try:
+            import cv2
+        except ImportError:
+            print("Python Library Module 'cv2' is required. ")
+            print("Obtain via 'sudo apt install python3-opencv'")
+            exit(2)
+        cam = cv2.VideoCapture(0)
+        if (not cam.isOpened()):
+            print('Could not open USB camera /dev/video0.')
+            exit(2)
+        cam.set(cv2.CAP_PROP_FRAME_WIDTH,800)
+        cam.set(cv2.CAP_PROP_FRAME_HEIGHT,600)
+        cam.set(cv2.CAP_PROP_BUFFERSIZE,1)
+
+    if (camera == 'pi'):
+        try:
+            from picamera2 import Picamera2
+        except ImportError:
+            print("Python Library Module 'picamera2' is required. ")
+            print("Obtain via 'sudo apt install python3-picamera2'")
+            exit(2)
+        cam = Picamera2()
+        cam.configure(cam.create_still_configuration({'size':(800,600),'format':'RGB888'}))
+        cam.start()
+
+    if (camera == 'web'):
+        cam = requests.Session()      # Keep-alive to the webcam between frames.
+
+    global capture
+    capture = CAPTURE[camera]
+
+def closeCamera():
+    if (camera == 'usb'): cam.release()
+    if (camera == 'pi'):
+        cam.stop()
+        cam.close()
+    if (camera == 'web'): cam.close()
+
+# Each capture function returns one frame as bytes, or None on failure. 
+# USB and Pi cameras give raw 800x600 BGR pixels, so nothing is JPEG encoded 
+# only for ffmpeg to decode it again.  Web cameras give a JPEG. 
+def usbPhoto():
+    cam.grab()                  # Discard the buffered frame, it may be stale.
+    ok, img = cam.read()
+    if (not ok):
+        print('Could not read a frame from the USB camera.')
+        return None
+    if (not img.shape[:2] == (600,800)): img = cv2.resize(img,(800,600))
+    return img.tobytes()
+
+def piPhoto():
+    return cam.capture_array().tobytes()    # RGB888 is stored B,G,R in memory.
+
+def webPhoto():
+    try:
+        r = cam.get(weburl,timeout=10)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        print('Could not get image from '+weburl+': '+str(e))
+        return None
+    return r.content
+
+CAPTURE = {'usb': usbPhoto, 'pi': piPhoto, 'web': webPhoto}
+
+def pickEncoder():
+    # Prefer the Pi's hardware H.264 encoder; fall back to software x264.
+    encoders = subprocess.run(['ffmpeg','-hide_banner','-encoders'],stdout=subprocess.PIPE,stderr=subprocess.DEVNULL,universal_newlines=True).stdout
+    try:
+        with open('/proc/device-tree/model') as f: isPi = ('Raspberry Pi' in f.read())
+    except OSError:
+        isPi = False
+    if (('h264_v4l2m2m' in encoders) and isPi and os.path.exists('/dev/video11')):
+        return(['-vcodec','h264_v4l2m2m','-b:v','4M','-g','30'])
+    if (('h264_omx' in encoders) and isPi):
+        return(['-vcodec','h264_omx','-b:v','4M','-g','30'])
+    # A 10 fps timelapse gains little from B-frames or long GOPs, and they cost CPU on a Pi. 
+    return(['-vcodec','libx264','-preset','ultrafast','-tune','fastdecode','-g','30','-bf','0','-crf','25'])
+
+def startVideo():
+    # Encode while we capture; each frame is piped straight into ffmpeg.
+    global ffmpeg, videoName
+    videoName = os.path.expanduser('~/DuetLapse'+time.strftime('%m%d%y%H%M',time.localtime())+'.mp4')
+    if (camera == 'web'):
+        cmd  = ['ffmpeg','-r','10','-f','image2pipe','-vcodec','mjpeg','-i','-']
+    else:
+        cmd  = ['ffmpeg','-f','rawvideo','-pix_fmt','bgr24','-s','800x600','-r','10','-i','-']
+    cmd += encoder
+    cmd += ['-s','800x600','-pix_fmt','yuv420p','-y','-v','8',videoName]
+    ffmpeg = subprocess.Popen(cmd,stdin=subprocess.PIPE)
+    threading.Thread(target=photoWorker,daemon=True).start()
+
+def photoWorker():
+    # Runs in its own thread, so a slow camera does not hold up watching the printer.
+    global videoFailed
+    while(1):
+        photos.get()
+        try:
+            img = capture()
+            if (img and not videoFailed):
+                ffmpeg.stdin.write(img)
+                ffmpeg.stdin.flush()
+        except BrokenPipeError:
+            videoFailed = True
+        except Exception as e:
+            # Lose this frame, but keep the worker alive so photos.join() always returns.
+            print('Could not capture a frame: '+str(e))
+        finally:
+            photos.task_done()
+
 def onePhoto():
     global frame
     frame += 1
-    s="{0:08d}".format(int(np.around(frame)))
-    fn = '/tmp/DuetLapse/IMG'+s+'.jpeg'
-
-    if ('usb' in camera): 
-        cmd = 'fswebcam --quiet -d v4l2:/dev/video0 -i 0 -r 800x600 -p YUYV --no-banner '+fn
-    if ('pi' in camera): 
-        cmd = 'raspistill -o '+fn
-    if ('web' in camera): 
-        cmd = 'wget --auth-no-challenge -nv -O '+fn+' "'+weburl+'"'
-
-    subprocess.call(cmd, shell=True)
+    photos.put(frame)
     global timePriorPhoto
     timePriorPhoto = time.time()
 
 
-def oneInterval():
+def oneInterval(status, zn):
     global frame
-    if ('layer' in detect):
+    # Check before anything can pause the printer, so we never exit leaving it paused.
+    if (videoFailed):
+        print('ffmpeg exited unexpectedly with code '+str(ffmpeg.wait())+', cannot continue.')
+        exit(2)
+    if (detectLayer):
         global zo
-        zn=printer.getCoords()['Z']
         if (not zn == zo):
             # Z changed, take a picture.
             checkForcePause()
-            print('Capturing frame {0:5d} at X{1:4.2f} Y{2:4.2f} Z{3:4.2f}'.format(int(np.around(frame)),printer.getCoords()['X'],printer.getCoords()['Y'],printer.getCoords()['Z']))
+            c = printer.getCoords()
+            print('Capturing frame {0:5d} at X{1:4.2f} Y{2:4.2f} Z{3:4.2f}'.format(frame,c['X'],c['Y'],c['Z']))
             onePhoto()
         zo = zn
     global timePriorPhoto
     elap = (time.time() - timePriorPhoto)
     if ((seconds) and (seconds < elap)):
         checkForcePause()
-        print('Capturing frame {0:5d} after {1:4.2f} seconds elapsed.'.format(int(np.around(frame)),elap))
+        print('Capturing frame {0:5d} after {1:4.2f} seconds elapsed.'.format(frame,elap))
         onePhoto()
-    if ('pause' in detect):
-        if ('paused' in printer.getStatus()):
-            print('Pause Detected, capturing frame {0:5d}'.format(int(np.around(frame)),elap))
+    if (detectPause):
+        if (status == PAUSED):
+            print('Pause Detected, capturing frame {0:5d}'.format(frame))
             onePhoto()
 
     unPause()            
 
 def postProcess():
     print()
-    print("Now making {0:d} frames into a video at 10 frames per second.".format(int(np.around(frame))))
-    if (250 < frame): print("This can take a while...")
-    fn ='~/DuetLapse'+time.strftime('%m%d%y%H%M',time.localtime())+'.mp4'
-    cmd  = 'ffmpeg -r 10 -i /tmp/DuetLapse/IMG%08d.jpeg -vcodec libx264 -crf 25 -s 800x600 -pix_fmt yuv420p -y -v 8 '+fn
-    subprocess.call(cmd, shell=True)
+    print("Finishing video of {0:d} frames at 10 frames per second.".format(frame))
+    photos.join()
+    closeCamera()
+    ffmpeg.stdin.close()
+    if (ffmpeg.wait()):
+        print('ffmpeg failed with code '+str(ffmpeg.returncode)+', video '+videoName+' may be incomplete.')
+        exit(2)
     print('Video processing complete.')
-    print('Video file is in home directory, named '+fn)
+    print('Video file is in home directory, named '+videoName)
     exit()    
 
 
+def mergePatch(model, patch):
+    # Apply an object model patch, as sent by DSF, onto our copy of the model.
+    for key, value in patch.items():
+        old = model.get(key)
+        if (isinstance(value, dict) and isinstance(old, dict)):
+            mergePatch(old, value)
+        elif (isinstance(value, list) and isinstance(old, list) and (len(value) == len(old))):
+            for i in range(len(value)):
+                if (isinstance(value[i], dict) and isinstance(old[i], dict)): mergePatch(old[i], value[i])
+                else: old[i] = value[i]
+        else:
+            model[key] = value
+
+def modelZ(model):
+    for axis in model['move']['axes']:
+        if (axis['letter'] == 'Z'): return(axis['userPosition'])
+    return(zo)
+
+def socketEvents(ws):
+    # DSF sends the full object model, then one patch each time we acknowledge
+    # with "OK" and something has changed.  If nothing changes for a while, 
+    # yield anyway so that -seconds triggers still fire. 
+    try:
+        model = json.loads(ws.recv())
+        acked = False
+        while(1):
+            if (not acked):
+                ws.send('OK\n')
+                acked = True
+            ws.settimeout(pollInterval())
+            try:
+                mergePatch(model, json.loads(ws.recv()))
+                acked = False
+            except websocket.WebSocketTimeoutException:
+                pass
+            yield printerStatus(model['state']['status']), modelZ(model)
+    except (websocket.WebSocketException, OSError, ValueError, KeyError):
+        print('Lost object model subscription to printer '+duet+', falling back to polling.')
+    finally:
+        ws.close()
+
+def getZ():
+    # Ask RRF3 for just the Z position, rather than the whole status of the machine. 
+    # Anything without rr_model, such as RRF2, stops being asked the first time the query fails.
+    global zFromModel
+    if (zFromModel):
+        try:
+            r = session.get(printer.baseURL()+'/rr_model?key=move.axes[2].userPosition&flags=d2',timeout=5)
+            return(float(r.json()['result']))
+        except (requests.RequestException, ValueError, KeyError, TypeError):
+            zFromModel = False
+    return(printer.getCoords()['Z'])
+
+def printerStatus(s):
+    # Normalize whatever the printer, or DuetWebAPI, called the state to one of the names above.
+    return(STATUS.get(s,s))
+
+def pollInterval():
+    # How long we may go without looking at the printer. 
+    if (printerState == 0): return(2.0)                 # Waiting for a print to start, no hurry.
+    if (seconds > 0): return(min(seconds/10, 0.5))
+    return(0.37)                                        # Intentionally not evenly divisible into one second. 
+
+def pollEvents():
+    # Wake on a fixed schedule, so time spent talking to the printer is not added to the interval.
+    nextWake = time.time()
+    while(1):
+        nextWake = max(nextWake + pollInterval(), time.time() + 0.1)
+        time.sleep(nextWake - time.time())
+        status = printerStatus(printer.getStatus())
+        zn = zo
+        if ((printerState == 1) and detectLayer): zn = getZ()
+        yield status, zn
+
+def printerEvents():
+    # Yields (status, Z) each time the printer state should be looked at. 
+    if (websocket and (printer.printerType() == 3)):
+        try:
+            ws = websocket.create_connection('ws://'+duet+'/machine',timeout=5)
+        except (websocket.WebSocketException, OSError):
+            ws = None
+        if (ws):
+            print('Subscribed to object model changes on printer '+duet)
+            yield from socketEvents(ws)
+    yield from pollEvents()
+
+
 ###########################
 # Main begins here
 ###########################
 init()
 
-while(1):
-    time.sleep(0.37)            # Intentionally not evenly divisible into one second. 
-    status=printer.getStatus()
-
+for status, zn in printerEvents():
     if (printerState == 0):     # Idle before print started. 
-        if ('processing' in status) or ('M' in status):
+        if (status == PRINTING) or (status == SIMULATING):
             print('Print start sensed.')
             print('End of print will be sensed, and frames will be converted into video.')
+            startVideo()
             printerState = 1
 
     elif (printerState == 1):   # Actually printing
-        oneInterval()
-        if ('idle' in status):
+        oneInterval(status, zn)
+        if (status == IDLE):
             printerState = 2
 
     elif (printerState == 2): 